@@ -3,13 +3,17 @@ Database Helper Functions
 
 MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
+All helpers are coroutines backed by the Motor async driver, so await them
+from async endpoints instead of blocking the event loop.
 """
 
-from pymongo import MongoClient
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import WriteConcern
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Optional, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -22,12 +26,15 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Pool sized for concurrent tenants; waiting callers fail after 2s instead of queueing indefinitely
+    _client = AsyncIOMotorClient(
+        database_url, tz_aware=True, maxPoolSize=200, minPoolSize=20, waitQueueTimeoutMS=2000
+    )
     db = _client[database_name]
 
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+async def insert_document(collection_name: str, data: Union[BaseModel, dict], write_concern: Optional[WriteConcern] = None) -> dict:
+    """Insert a single document with timestamp and return it as stored (including _id)"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -37,13 +44,46 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+    # Generate the id client-side: the caller knows it without any read-back
+    data_dict.setdefault('_id', ObjectId())
+
+    collection = db[collection_name]
+    if write_concern is not None:
+        collection = collection.with_options(write_concern=write_concern)
+    await collection.insert_one(data_dict)
+    return data_dict
+
+async def create_document(collection_name: str, data: Union[BaseModel, dict], write_concern: Optional[WriteConcern] = None):
+    """Insert a single document with timestamp"""
+    doc = await insert_document(collection_name, data, write_concern)
+    return str(doc["_id"])
+
+async def create_documents(collection_name: str, items: List[Union[BaseModel, dict]], ordered: bool = True):
+    """Insert many documents with timestamps in a single batch write
+
+    Ids are assigned client-side, so callers can pass their own _id to link
+    documents before the write. With ordered=False, one failing document
+    (e.g. a duplicate key) does not stop the rest of the batch.
+    """
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    docs = []
+    for data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        data_dict.setdefault('_id', ObjectId())
+        docs.append(data_dict)
 
-    result = db[collection_name].insert_one(data_dict)
-    return str(result.inserted_id)
+    await db[collection_name].insert_many(docs, ordered=ordered)
+    return [str(d['_id']) for d in docs]
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +92,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
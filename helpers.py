@@ -0,0 +1,44 @@
+"""
+Hot-path helpers
+
+Small, fully annotated functions called on nearly every request. They are kept
+in their own module so it can be compiled with mypyc (see start_server.sh);
+the pure-Python module is used unchanged when no compiled build is present.
+"""
+
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+
+USER_SECRET_FIELDS = ("password_hash", "verification_token", "reset_token")
+# Projection that never sends credentials back
+USER_PUBLIC_FIELDS: Dict[str, Any] = {f: 0 for f in USER_SECRET_FIELDS}
+
+
+# Hot ids (the active board, its tasks) repeat across requests; ObjectId is immutable so sharing is safe.
+# Invalid ids raise and are never cached.
+@lru_cache(maxsize=1024)
+def oid(id_str: str) -> ObjectId:
+    try:
+        return ObjectId(id_str)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid ID")
+
+
+def public_user(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Same as reading with USER_PUBLIC_FIELDS, for docs built locally
+    for f in USER_SECRET_FIELDS:
+        doc.pop(f, None)
+    return doc
+
+
+def serialize(doc: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    # Datetimes are left as-is: ORJSONResponse encodes them natively
+    if not doc:
+        return doc
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
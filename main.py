@@ -1,79 +1,135 @@
+import asyncio
 import os
-from fastapi import FastAPI, HTTPException, UploadFile, File, Request, WebSocket, WebSocketDisconnect
+import re
+import shutil
+import time
+from collections import deque
+from secrets import token_hex
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, UploadFile, File, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import ENCODERS_BY_TYPE
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from typing import Optional, List, Literal, Dict, Any
+from fastapi.responses import FileResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from typing import Optional, List, Literal, Dict, Any, Deque, Tuple
 from bson import ObjectId
+from async_lru import alru_cache
+from cachetools import TLRUCache
+from pymongo import ReturnDocument, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit
 
-from database import db, create_document
-from schemas import User, Clientprofile, Message, Notification, Document, Invoice, Workrequest, Quote, Token, Kanbantask
+from database import db, create_document, create_documents, insert_document
+from helpers import USER_PUBLIC_FIELDS, oid, public_user, serialize
+from schemas import User, Clientprofile, Token, Kanbantask
 
-app = FastAPI()
+# ObjectIds left in a response body (e.g. clientprofile.user_id) go out as plain strings
+ENCODERS_BY_TYPE[ObjectId] = str
+
+
+def _orjson_default(obj: Any) -> str:
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+class DocsResponse(ORJSONResponse):
+    """Returned directly by list endpoints to skip jsonable_encoder's per-field walk;
+    orjson writes the serialized Mongo docs (datetimes included) in one pass."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=_orjson_default)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Test runs set TESTING=1 so the suite can read issued OTP codes without querying Mongo
+TESTING = bool(os.getenv("TESTING"))
+if TESTING:
+    app.state.last_otp = {}
+
+# Comma-separated frontend origins, e.g. "https://portal.example.com,http://localhost:5173".
+# Explicit lists skip Starlette's wildcard handling; "*" remains the fallback for local dev.
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()] or ["*"]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST", "PATCH"],
+    allow_headers=["content-type", "authorization", "x-user-role"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Ensure uploads dir exists
-UPLOAD_DIR = os.path.join(os.getcwd(), "uploads")
+# Ensure uploads dir exists; UPLOAD_DIR overrides it (the test suite points it at a temp dir)
+UPLOAD_DIR = os.getenv("UPLOAD_DIR") or os.path.join(os.getcwd(), "uploads")
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 # ---------------------- Realtime (WebSockets) ----------------------
 class ConnectionManager:
     def __init__(self):
-        # client_id -> set of websockets
-        self.active: Dict[str, List[WebSocket]] = {}
+        # client_id -> {websocket: (outbound queue, relay task)}
+        self.active: Dict[str, Dict[WebSocket, Tuple[asyncio.Queue, asyncio.Task]]] = {}
 
     async def connect(self, client_id: str, websocket: WebSocket):
         await websocket.accept()
-        self.active.setdefault(client_id, []).append(websocket)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=64)
+        task = asyncio.create_task(self._relay(client_id, websocket, queue))
+        self.active.setdefault(client_id, {})[websocket] = (queue, task)
 
     def disconnect(self, client_id: str, websocket: WebSocket):
-        arr = self.active.get(client_id)
-        if not arr:
+        conns = self.active.get(client_id)
+        if not conns:
             return
-        if websocket in arr:
-            arr.remove(websocket)
-        if not arr:
+        entry = conns.pop(websocket, None)
+        if entry is not None:
+            entry[1].cancel()
+        if not conns:
             self.active.pop(client_id, None)
 
-    async def broadcast(self, client_id: str, message: Dict[str, Any]):
-        conns = list(self.active.get(client_id, []))
-        for ws in conns:
-            try:
-                await ws.send_json(message)
-            except RuntimeError:
-                # skip dead
-                pass
+    async def _relay(self, client_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        # One long-lived sender per socket, so a slow client only backs up its own queue
+        try:
+            while True:
+                message = await queue.get()
+                await websocket.send_text(message)
+        except Exception:
+            # dead socket
+            self.disconnect(client_id, websocket)
+
+    def broadcast(self, client_id: str, message: Dict[str, Any]):
+        conns = self.active.get(client_id)
+        if not conns:
+            return
+        # Encode once; every subscriber gets the same text frame
+        payload = orjson.dumps(message).decode()
+        for queue, _ in list(conns.values()):
+            if queue.full():
+                # drop the oldest event rather than block the mutation that triggered this one
+                queue.get_nowait()
+            queue.put_nowait(payload)
 
 manager = ConnectionManager()
 
 # Helpers
 
-def oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception:
-        raise HTTPException(status_code=400, detail="Invalid ID")
+# Projections: only pull the fields a response needs
+LOW_VALUE_WRITES = WriteConcern(w=1, j=False)
+MESSAGE_FIELDS = {"client_id": 1, "sender_id": 1, "sender_role": 1, "content": 1, "created_at": 1}
+TENANT_FIELDS = {"display_name": 1, "theme_color": 1, "logo_url": 1, "custom_domain": 1}
+CLIENT_LIST_FIELDS = {"user_id": 1, "display_name": 1, "theme_color": 1, "logo_url": 1, "custom_domain": 1, "updated_at": 1}
 
 
-def serialize(doc: Dict[str, Any]) -> Dict[str, Any]:
-    if not doc:
-        return doc
-    doc = dict(doc)
-    if "_id" in doc:
-        doc["id"] = str(doc.pop("_id"))
-    # Convert datetime to isoformat
-    for k, v in list(doc.items()):
-        if isinstance(v, datetime):
-            doc[k] = v.isoformat()
-    return doc
+async def newest_page(collection: str, q: Dict[str, Any], after_id: Optional[str], limit: int) -> DocsResponse:
+    # Newest first, keyset on _id: pass the X-Next-Cursor header back as ?after_id= for the next page
+    if after_id:
+        q["_id"] = {"$lt": oid(after_id)}
+    cursor = db[collection].find(q).sort("_id", -1).limit(limit).batch_size(min(limit, 200))
+    items = [serialize(d) async for d in cursor]
+    headers = {"X-Next-Cursor": items[-1]["id"]} if len(items) == limit else None
+    return DocsResponse(items, headers=headers)
 
 
 def require_pm_or_admin(request: Request):
@@ -83,12 +139,23 @@ def require_pm_or_admin(request: Request):
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Client Portal API Running"}
 
 
+# (fetched_at, names) for /test, which is polled as a health probe
+_collections_snapshot: Optional[Tuple[float, List[str]]] = None
+
+
+async def cached_collection_names(max_age: float = 30.0) -> List[str]:
+    global _collections_snapshot
+    if _collections_snapshot is None or time.monotonic() - _collections_snapshot[0] > max_age:
+        _collections_snapshot = (time.monotonic(), await db.list_collection_names())
+    return _collections_snapshot[1]
+
+
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -104,7 +171,7 @@ def test_database():
             response["database_name"] = db.name
             response["connection_status"] = "Connected"
             try:
-                response["collections"] = db.list_collection_names()
+                response["collections"] = await cached_collection_names()
             except Exception:
                 pass
         else:
@@ -115,7 +182,27 @@ def test_database():
 
 
 # ---------------------- Auth ----------------------
+def _token_ttu(_token: str, value: Tuple[Optional[Dict[str, Any]], Optional[datetime]], now: float) -> float:
+    # Revalidate at least once a minute, and never serve a token past its own expiry
+    expires_at = value[1]
+    return min(now + 60, expires_at.timestamp()) if expires_at else now + 60
+
+
+# token -> (serialized user, expires_at), so a warm /auth/me makes no Mongo round trips
+_token_cache: TLRUCache = TLRUCache(maxsize=4096, ttu=_token_ttu, timer=time.time)
+_token_pool: Deque[str] = deque()
+
+
+def next_token() -> str:
+    # Refill in batches so issuing a session token is usually a deque pop
+    if not _token_pool:
+        _token_pool.extend(token_hex(12) for _ in range(1024))
+    return _token_pool.pop()
+
+
 class LoginPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     email: str
     name: Optional[str] = None
     password: Optional[str] = None
@@ -124,11 +211,11 @@ class LoginPayload(BaseModel):
 
 
 @app.post("/auth/login")
-def login(payload: LoginPayload):
+async def login(payload: LoginPayload):
     """Very simple login: if user doesn't exist, create it. Returns a token.
     Use role from payload when creating; existing users keep their role.
     """
-    user = db["user"].find_one({"email": payload.email})
+    user = await db["user"].find_one({"email": payload.email}, USER_PUBLIC_FIELDS)
     if not user:
         new_user = User(
             name=payload.name or payload.email.split("@")[0],
@@ -138,42 +225,68 @@ def login(payload: LoginPayload):
             company=payload.company,
             is_active=True,
         )
-        user_id = create_document("user", new_user)
-        user = db["user"].find_one({"_id": ObjectId(user_id)})
+        user = public_user(await insert_document("user", new_user))
         # Auto create client profile if role=client
         if new_user.role == "client":
             prof = Clientprofile(
-                user_id=str(user_id),
+                user_id=user["_id"],
                 display_name=new_user.name,
                 theme_color="#4f46e5",
                 logo_url=None,
                 notes=None,
                 custom_domain=None,
             )
-            create_document("clientprofile", prof)
+            await create_document("clientprofile", prof)
 
-    token_value = os.urandom(12).hex()
-    expires = datetime.now(timezone.utc) + timedelta(days=7)
-    db["token"].insert_one({
-        "user_id": str(user["_id"]),
+    token_value = next_token()
+    now = datetime.now(timezone.utc)
+    await db["token"].insert_one({
+        "user_id": user["_id"],
         "token": token_value,
-        "expires_at": expires,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
+        "expires_at": now + timedelta(days=7),
+        "created_at": now,
+        "updated_at": now,
     })
     return {"token": token_value, "user": serialize(user)}
 
 
 class RequestOtpPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     email: str
     name: Optional[str] = None
     role: Optional[Literal["admin", "project_manager", "client", "viewer"]] = None
 
 
+# Shared pool for outbound API calls (SendGrid)
+http_client = httpx.AsyncClient(timeout=5, limits=httpx.Limits(max_connections=50))
+
+
+async def send_otp_email(email: str, code: str):
+    sg_key = os.getenv("SENDGRID_API_KEY")
+    if not sg_key or not email:
+        print(f"[OTP] Verification code for {email}: {code}")
+        return
+    data = {
+        "personalizations": [{"to": [{"email": email}], "subject": "Your verification code"}],
+        "from": {"email": os.getenv("EMAIL_FROM", "no-reply@example.com")},
+        "content": [{"type": "text/plain", "value": f"Your login code is: {code}. It expires in 10 minutes."}],
+    }
+    try:
+        await http_client.post(
+            "https://api.sendgrid.com/v3/mail/send",
+            headers={"Authorization": f"Bearer {sg_key}"},
+            json=data,
+        )
+    except Exception as e:
+        print(f"[OTP] Email send fallback due to error: {e}")
+        print(f"[OTP] Verification code for {email}: {code}")
+
+
 @app.post("/auth/request-otp")
-def request_otp(payload: RequestOtpPayload):
+async def request_otp(payload: RequestOtpPayload, background_tasks: BackgroundTasks):
     # Create user if not exists
-    user = db["user"].find_one({"email": payload.email})
+    user = await db["user"].find_one({"email": payload.email}, {"_id": 1})
     if not user:
         new_user = User(
             name=payload.name or payload.email.split("@")[0],
@@ -183,103 +296,103 @@ def request_otp(payload: RequestOtpPayload):
             company=None,
             is_active=True,
         )
-        uid = create_document("user", new_user)
-        user = db["user"].find_one({"_id": ObjectId(uid)})
+        user = await insert_document("user", new_user)
         if new_user.role == "client":
             prof = Clientprofile(
-                user_id=str(uid),
+                user_id=user["_id"],
                 display_name=new_user.name,
                 theme_color="#4f46e5",
                 logo_url=None,
                 notes=None,
                 custom_domain=None,
             )
-            create_document("clientprofile", prof)
+            await create_document("clientprofile", prof)
 
     # Generate a 6-digit code valid for 10 minutes
     code = f"{int.from_bytes(os.urandom(3), 'big') % 1000000:06d}"
-    expires = datetime.now(timezone.utc) + timedelta(minutes=10)
-    db["otp"].delete_many({"email": payload.email})
-    db["otp"].insert_one({
-        "email": payload.email,
-        "code": code,
-        "expires_at": expires,
-        "created_at": datetime.now(timezone.utc)
-    })
-
-    # Try to email via SendGrid if configured, otherwise log
-    sg_key = os.getenv("SENDGRID_API_KEY")
-    from_email = os.getenv("EMAIL_FROM", "no-reply@example.com")
-    if sg_key and payload.email:
-        try:
-            import requests
-            data = {
-                "personalizations": [{"to": [{"email": payload.email}], "subject": "Your verification code"}],
-                "from": {"email": from_email},
-                "content": [{"type": "text/plain", "value": f"Your login code is: {code}. It expires in 10 minutes."}],
-            }
-            requests.post(
-                "https://api.sendgrid.com/v3/mail/send",
-                headers={"Authorization": f"Bearer {sg_key}", "Content-Type": "application/json"},
-                json=data,
-                timeout=5,
-            )
-        except Exception as e:
-            print(f"[OTP] Email send fallback due to error: {e}")
-            print(f"[OTP] Verification code for {payload.email}: {code}")
-    else:
-        print(f"[OTP] Verification code for {payload.email}: {code}")
+    now = datetime.now(timezone.utc)
+    # One live code per email; expired ones are reaped by the otp.expires_at TTL index
+    await db["otp"].replace_one(
+        {"email": payload.email},
+        {"email": payload.email, "code": code, "expires_at": now + timedelta(minutes=10), "created_at": now},
+        upsert=True,
+    )
+    if TESTING:
+        app.state.last_otp[payload.email] = code
 
+    # Mail goes out after the response; falls back to logging the code when SendGrid isn't configured
+    background_tasks.add_task(send_otp_email, payload.email, code)
     return {"status": "sent"}
 
 
 class VerifyOtpPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     email: str
     code: str
 
 
 @app.post("/auth/verify-otp")
-def verify_otp(payload: VerifyOtpPayload):
-    rec = db["otp"].find_one({"email": payload.email, "code": payload.code})
-    if not rec or (rec.get("expires_at") and rec["expires_at"] < datetime.now(timezone.utc)):
+async def verify_otp(payload: VerifyOtpPayload):
+    now = datetime.now(timezone.utc)
+    rec = await db["otp"].find_one({"email": payload.email, "code": payload.code}, {"expires_at": 1})
+    if not rec or (rec.get("expires_at") and rec["expires_at"] < now):
         raise HTTPException(status_code=400, detail="Invalid or expired code")
-    user = db["user"].find_one({"email": payload.email})
+    user = await db["user"].find_one({"email": payload.email}, USER_PUBLIC_FIELDS)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     # Issue token
-    token_value = os.urandom(12).hex()
-    expires = datetime.now(timezone.utc) + timedelta(days=7)
-    db["token"].insert_one({
-        "user_id": str(user["_id"]),
+    token_value = next_token()
+    await db["token"].insert_one({
+        "user_id": user["_id"],
         "token": token_value,
-        "expires_at": expires,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
+        "expires_at": now + timedelta(days=7),
+        "created_at": now,
+        "updated_at": now,
     })
     # Cleanup used code
-    db["otp"].delete_many({"email": payload.email})
+    await db["otp"].delete_many({"email": payload.email})
     return {"token": token_value, "user": serialize(user)}
 
 
 @app.get("/auth/me")
-def me(token: str):
-    t = db["token"].find_one({"token": token})
-    if not t or (t.get("expires_at") and t["expires_at"] < datetime.now(timezone.utc)):
-        raise HTTPException(status_code=401, detail="Invalid token")
-    user = db["user"].find_one({"_id": ObjectId(t["user_id"])})
-    return serialize(user)
+async def me(token: str):
+    cached = _token_cache.get(token)
+    if cached is None:
+        # The TTL index on expires_at removes expired tokens, so a miss means invalid or expired
+        t = await db["token"].find_one({"token": token}, {"user_id": 1, "expires_at": 1, "_id": 0})
+        if not t:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        user = serialize(await db["user"].find_one({"_id": ObjectId(t["user_id"])}, USER_PUBLIC_FIELDS))
+        cached = _token_cache[token] = (user, t.get("expires_at"))
+    return cached[0]
+
+
+@app.post("/auth/logout")
+async def logout(token: str):
+    await db["token"].delete_one({"token": token})
+    _token_cache.pop(token, None)
+    return {"status": "ok"}
 
 
 # ---------------------- Tenant Resolution ----------------------
+@alru_cache(maxsize=1024, ttl=300)
+async def tenant_for_host(host: str) -> Optional[Dict[str, Any]]:
+    # Hit on every white-label page load and custom domains rarely change; profile writers call cache_clear()
+    return await db["clientprofile"].find_one({"custom_domain": host}, TENANT_FIELDS)
+
+
 @app.get("/tenant/resolve")
-def resolve_tenant(host: Optional[str] = None):
+async def resolve_tenant(host: Optional[str] = None):
     host = host or os.getenv("HOSTNAME") or ""
-    prof = db["clientprofile"].find_one({"custom_domain": host})
-    return serialize(prof) if prof else {}
+    prof = await tenant_for_host(host)
+    return serialize(dict(prof)) if prof else {}
 
 
 # ---------------------- Clients ----------------------
 class CreateClientPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     email: str
     name: str
     company: Optional[str] = None
@@ -288,6 +401,8 @@ class CreateClientPayload(BaseModel):
 
 
 class UpdateClientPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     display_name: Optional[str] = None
     theme_color: Optional[str] = None
     logo_url: Optional[str] = None
@@ -296,15 +411,23 @@ class UpdateClientPayload(BaseModel):
 
 
 @app.get("/clients")
-def list_clients() -> List[Dict[str, Any]]:
-    profiles = list(db["clientprofile"].aggregate([
-        {"$lookup": {"from": "user", "localField": "user_id", "foreignField": "_id", "as": "user_obj"}},
-    ]))
-    return [serialize(p) for p in profiles]
+async def list_clients():
+    profiles = await db["clientprofile"].find({}, CLIENT_LIST_FIELDS).batch_size(500).to_list(length=None)
+    # One batched _id lookup for all users; ObjectId() also normalizes legacy string user_ids
+    user_ids = [ObjectId(p["user_id"]) for p in profiles if ObjectId.is_valid(p.get("user_id"))]
+    users = {
+        str(u["_id"]): serialize(u)
+        async for u in db["user"].find({"_id": {"$in": user_ids}}, {"email": 1, "name": 1}).batch_size(500)
+    }
+    for p in profiles:
+        user = users.get(str(p.get("user_id")))
+        p["user_obj"] = [user] if user else []
+        serialize(p)
+    return DocsResponse(profiles)
 
 
 @app.post("/clients")
-def create_client(payload: CreateClientPayload):
+async def create_client(payload: CreateClientPayload):
     # Create user with client role
     u = User(
         name=payload.name,
@@ -314,49 +437,62 @@ def create_client(payload: CreateClientPayload):
         company=payload.company,
         is_active=True,
     )
-    user_id = create_document("user", u)
+    try:
+        user_id = (await insert_document("user", u))["_id"]
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Email already registered")
     prof = Clientprofile(
-        user_id=str(user_id),
+        user_id=user_id,
         display_name=payload.name,
         theme_color=payload.theme_color,
         logo_url=payload.logo_url,
         notes=None,
         custom_domain=None,
     )
-    prof_id = create_document("clientprofile", prof)
-    return {"user_id": user_id, "profile_id": prof_id}
+    prof_id = await create_document("clientprofile", prof)
+    return {"user_id": str(user_id), "profile_id": prof_id}
+
+
+@alru_cache(maxsize=4096, ttl=30)
+async def get_client_profile(client_id: str) -> Optional[Dict[str, Any]]:
+    # Read-mostly and fetched on every portal view; writers call cache_invalidate(client_id)
+    return await db["clientprofile"].find_one({"_id": oid(client_id)})
 
 
 @app.get("/clients/{client_id}")
-def get_client(client_id: str):
-    prof = db["clientprofile"].find_one({"_id": oid(client_id)})
+async def get_client(client_id: str):
+    prof = await get_client_profile(client_id)
     if not prof:
         raise HTTPException(status_code=404, detail="Client not found")
-    return serialize(prof)
+    return serialize(dict(prof))
 
 
 @app.patch("/clients/{client_id}")
-def update_client(request: Request, client_id: str, payload: UpdateClientPayload):
+async def update_client(request: Request, client_id: str, payload: UpdateClientPayload):
     # Restrict branding updates to PM/Admin
     require_pm_or_admin(request)
     update = {k: v for k, v in payload.model_dump().items() if v is not None}
     if not update:
-        return get_client(client_id)
+        return await get_client(client_id)
     update["updated_at"] = datetime.now(timezone.utc)
-    res = db["clientprofile"].update_one({"_id": oid(client_id)}, {"$set": update})
-    if res.matched_count == 0:
+    prof = await db["clientprofile"].find_one_and_update(
+        {"_id": oid(client_id)}, {"$set": update}, return_document=ReturnDocument.AFTER
+    )
+    if prof is None:
         raise HTTPException(status_code=404, detail="Client not found")
-    prof = db["clientprofile"].find_one({"_id": oid(client_id)})
+    get_client_profile.cache_invalidate(client_id)
+    tenant_for_host.cache_clear()
     # Notify branding change
-    try:
-        import asyncio
-        asyncio.create_task(manager.broadcast(client_id, {"type": "brand:update"}))
-    except Exception:
-        pass
+    manager.broadcast(client_id, {"type": "brand:update"})
     return serialize(prof)
 
 
 # Logo upload endpoints
+def _save_upload(src, dest: str):
+    with open(dest, "wb") as out:
+        shutil.copyfileobj(src, out, 1 << 16)
+
+
 @app.post("/clients/{client_id}/logo")
 async def upload_logo(request: Request, client_id: str, file: UploadFile = File(...)):
     # Restrict to PM/Admin
@@ -365,23 +501,20 @@ async def upload_logo(request: Request, client_id: str, file: UploadFile = File(
     ext = os.path.splitext(file.filename)[1].lower()
     safe_name = f"{client_id}_logo{ext or '.png'}"
     dest = os.path.join(UPLOAD_DIR, safe_name)
-    with open(dest, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    # Copy the spooled upload in 64 KiB chunks on a worker thread: bounded memory, no blocking disk I/O on the loop
+    await asyncio.to_thread(_save_upload, file.file, dest)
     # Construct a simple local URL path
     url_path = f"/uploads/{safe_name}"
     # Persist on client profile
-    db["clientprofile"].update_one({"_id": oid(client_id)}, {"$set": {"logo_url": url_path, "updated_at": datetime.now(timezone.utc)}})
+    await db["clientprofile"].update_one({"_id": oid(client_id)}, {"$set": {"logo_url": url_path, "updated_at": datetime.now(timezone.utc)}})
+    get_client_profile.cache_invalidate(client_id)
+    tenant_for_host.cache_clear()
     # Broadcast change
-    try:
-        import asyncio
-        asyncio.create_task(manager.broadcast(client_id, {"type": "brand:logo", "url": url_path}))
-    except Exception:
-        pass
+    manager.broadcast(client_id, {"type": "brand:logo", "url": url_path})
     return {"url": url_path}
 
 @app.get("/uploads/{filename}")
-def get_uploaded_file(filename: str):
+async def get_uploaded_file(filename: str):
     path = os.path.join(UPLOAD_DIR, filename)
     if not os.path.isfile(path):
         raise HTTPException(status_code=404, detail="File not found")
@@ -390,7 +523,7 @@ def get_uploaded_file(filename: str):
 
 # Seed three dummy clients if missing
 
-def ensure_dummy_clients():
+async def ensure_dummy_clients():
     samples = [
         {
             "email": "acme.facilities@example.com",
@@ -414,47 +547,102 @@ def ensure_dummy_clients():
             "logo_url": "https://dummyimage.com/120x120/22c55e/0b1026&text=TC",
         },
     ]
-    for s in samples:
-        # If user exists, skip
-        existing_user = db["user"].find_one({"email": s["email"]})
-        if existing_user:
-            continue
-        # Create user
-        u = User(
-            name=s["name"],
-            email=s["email"],
-            password_hash="demo",
-            role="client",
-            company=s.get("company"),
-            is_active=True,
-        )
-        user_id = create_document("user", u)
-        # Create client profile
-        prof = Clientprofile(
-            user_id=str(user_id),
+    # One query to find which samples already exist, then one batch insert per collection
+    emails = [s["email"] for s in samples]
+    existing = {u["email"] async for u in db["user"].find({"email": {"$in": emails}}, {"email": 1})}
+    missing = [s for s in samples if s["email"] not in existing]
+    if not missing:
+        return
+    # Pre-generated ids let profiles be built without reading the users back
+    seeds = [(s, ObjectId()) for s in missing]
+    users = [
+        {
+            **User(
+                name=s["name"],
+                email=s["email"],
+                password_hash="demo",
+                role="client",
+                company=s.get("company"),
+                is_active=True,
+            ).model_dump(),
+            "_id": user_id,
+        }
+        for s, user_id in seeds
+    ]
+    try:
+        # Unordered: if another worker seeded one of these emails first, the rest still go in
+        await create_documents("user", users, ordered=False)
+    except BulkWriteError as e:
+        failed = {err["index"] for err in e.details.get("writeErrors", [])}
+        seeds = [seed for i, seed in enumerate(seeds) if i not in failed]
+    profiles = [
+        Clientprofile(
+            user_id=user_id,
             display_name=s["name"],
             theme_color=s.get("theme_color") or "#4f46e5",
             logo_url=s.get("logo_url"),
             notes="Dummy seeded client",
             custom_domain=None,
         )
-        create_document("clientprofile", prof)
+        for s, user_id in seeds
+    ]
+    if profiles:
+        await create_documents("clientprofile", profiles, ordered=False)
+
+
+# (collection, keys, options): compound (filter, sort) indexes so list endpoints read pre-sorted ranges
+_INDEXES = [
+    ("clientprofile", "user_id", {}),
+    ("clientprofile", "custom_domain", {}),
+    ("message", [("client_id", 1), ("_id", 1)], {}),
+    ("notification", [("user_id", 1), ("_id", -1)], {}),
+    ("notification", [("user_id", 1), ("read", 1)], {"partialFilterExpression": {"read": False}}),
+    *((name, [("client_id", 1), ("_id", -1)], {}) for name in ("document", "invoice", "workrequest", "quote")),
+    ("kanbantask", [("client_id", 1), ("status", 1), ("position", 1), ("created_at", 1)], {}),
+    ("kanbantask", [("title", "text"), ("description", "text")], {}),
+    ("token", "token", {"unique": True}),
+    ("token", "expires_at", {"expireAfterSeconds": 0}),
+    ("user", "email", {"unique": True}),
+    ("otp", "email", {"unique": True}),
+    ("otp", "expires_at", {"expireAfterSeconds": 0}),
+]
+
+
+async def ensure_indexes():
+    # Each index on its own: one failing (e.g. a unique index over existing duplicates) must not skip the rest
+    for coll, keys, opts in _INDEXES:
+        try:
+            await db[coll].create_index(keys, **opts)
+        except Exception as e:
+            print(f"[DB] Could not create index {keys!r} on {coll}: {e}")
 
 
 @app.on_event("startup")
 async def startup_seed():
     try:
-        # Only seed if there are fewer than 3 client profiles
-        count = db["clientprofile"].count_documents({})
-        if count < 3:
-            ensure_dummy_clients()
+        count = await db["clientprofile"].count_documents({})
     except Exception:
         # If DB not available, ignore
-        pass
+        return
+    # Only seed if there are fewer than 3 client profiles
+    if count < 3:
+        try:
+            await ensure_dummy_clients()
+        except Exception as e:
+            print(f"[DB] Seeding dummy clients failed: {e}")
+    await ensure_indexes()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+    await _batch_client.aclose()
 
 
 # ---------------------- Messages (Chat) ----------------------
 class MessagePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     sender_id: str
     sender_role: Literal["admin", "project_manager", "client", "viewer"]
@@ -462,45 +650,74 @@ class MessagePayload(BaseModel):
 
 
 @app.get("/messages")
-def get_messages(client_id: str, limit: int = 100):
-    msgs = db["message"].find({"client_id": client_id}).sort("created_at", 1).limit(limit)
-    return [serialize(m) for m in msgs]
-
-
-@app.post("/messages")
-def post_message(payload: MessagePayload):
-    m = Message(**payload.model_dump())
-    mid = create_document("message", m)
+async def get_messages(
+    client_id: str,
+    after_id: Optional[str] = None,
+    after: Optional[str] = Query(None, deprecated=True),
+    limit: int = Query(100, ge=1, le=500),
+):
+    # Keyset pagination on _id: pass the X-Next-Cursor header back as ?after_id= for the next page
+    # (?after= is the older name for the same cursor)
+    q: Dict[str, Any] = {"client_id": client_id}
+    after_id = after_id or after
+    if after_id:
+        q["_id"] = {"$gt": oid(after_id)}
+    cursor = db["message"].find(q, MESSAGE_FIELDS).sort("_id", 1).limit(limit).batch_size(min(limit, 200))
+    msgs = [serialize(m) async for m in cursor]
+    headers = {"X-Next-Cursor": msgs[-1]["id"]} if len(msgs) == limit else None
+    return DocsResponse(msgs, headers=headers)
+
+
+# The body is read raw below, so its schema is declared for OpenAPI by hand
+@app.post(
+    "/messages",
+    openapi_extra={
+        "requestBody": {"content": {"application/json": {"schema": MessagePayload.model_json_schema()}}, "required": True}
+    },
+)
+async def post_message(request: Request):
+    # Hot path: validate the raw body straight into the model instead of going through a dict
+    try:
+        payload = MessagePayload.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+    mid = await create_document("message", payload.model_dump(), LOW_VALUE_WRITES)
     return {"id": mid}
 
 
 # ---------------------- Notifications ----------------------
 class NotificationPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     user_id: str
     text: str
 
 
 @app.get("/notifications")
-def get_notifications(user_id: str):
-    notes = db["notification"].find({"user_id": user_id}).sort("created_at", -1)
-    return [serialize(n) for n in notes]
+async def get_notifications(user_id: str, after_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    return await newest_page("notification", {"user_id": user_id}, after_id, limit)
 
 
 @app.post("/notifications")
-def create_notification(payload: NotificationPayload):
-    n = Notification(**payload.model_dump())
-    nid = create_document("notification", n)
+async def create_notification(payload: NotificationPayload):
+    nid = await create_document("notification", {**payload.model_dump(), "read": False}, LOW_VALUE_WRITES)
     return {"id": nid}
 
 
 @app.post("/notifications/read")
-def mark_notifications_read(user_id: str):
-    db["notification"].update_many({"user_id": user_id}, {"$set": {"read": True, "updated_at": datetime.now(timezone.utc)}})
+async def mark_notifications_read(user_id: str):
+    # Unread-only filter hits the partial index; read flags are low value, so w=1 without journaling
+    await db["notification"].with_options(write_concern=LOW_VALUE_WRITES).update_many(
+        {"user_id": user_id, "read": False},
+        {"$set": {"read": True, "updated_at": datetime.now(timezone.utc)}},
+    )
     return {"status": "ok"}
 
 
 # ---------------------- Documents & Invoices ----------------------
 class DocumentPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     filename: str
     url: str
@@ -509,82 +726,80 @@ class DocumentPayload(BaseModel):
 
 
 @app.get("/documents")
-def get_documents_api(client_id: str):
-    docs = db["document"].find({"client_id": client_id}).sort("created_at", -1)
-    return [serialize(d) for d in docs]
+async def get_documents_api(client_id: str, after_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    return await newest_page("document", {"client_id": client_id}, after_id, limit)
 
 
 @app.post("/documents")
-def create_document_api(payload: DocumentPayload):
-    d = Document(**payload.model_dump())
-    did = create_document("document", d)
+async def create_document_api(payload: DocumentPayload):
+    did = await create_document("document", payload.model_dump())
     return {"id": did}
 
 
 class InvoicePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     number: str
-    amount: float
-    status: Optional[Literal["draft", "sent", "paid", "overdue"]] = "sent"
+    amount: float = Field(..., ge=0)
+    status: Literal["draft", "sent", "paid", "overdue"] = "sent"
     url: Optional[str] = None
 
 
 @app.get("/invoices")
-def get_invoices(client_id: str):
-    invs = db["invoice"].find({"client_id": client_id}).sort("created_at", -1)
-    return [serialize(i) for i in invs]
+async def get_invoices(client_id: str, after_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    return await newest_page("invoice", {"client_id": client_id}, after_id, limit)
 
 
 @app.post("/invoices")
-def create_invoice(payload: InvoicePayload):
-    inv = Invoice(**payload.model_dump())
-    iid = create_document("invoice", inv)
+async def create_invoice(payload: InvoicePayload):
+    iid = await create_document("invoice", payload.model_dump())
     return {"id": iid}
 
 
 # ---------------------- Work Requests & Quotes ----------------------
 class WorkRequestPayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     title: str
     description: str
 
 
 @app.get("/work-requests")
-def list_work_requests(client_id: str):
-    wrs = db["workrequest"].find({"client_id": client_id}).sort("created_at", -1)
-    return [serialize(w) for w in wrs]
+async def list_work_requests(client_id: str, after_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    return await newest_page("workrequest", {"client_id": client_id}, after_id, limit)
 
 
 @app.post("/work-requests")
-def create_work_request(payload: WorkRequestPayload):
-    wr = Workrequest(client_id=payload.client_id, title=payload.title, description=payload.description)
-    wid = create_document("workrequest", wr)
+async def create_work_request(payload: WorkRequestPayload):
+    wid = await create_document("workrequest", {**payload.model_dump(), "status": "new"})
     return {"id": wid}
 
 
 class QuotePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     work_request_id: str
-    amount: float
+    amount: float = Field(..., ge=0)
 
 
 @app.get("/quotes")
-def list_quotes(client_id: str):
-    qs = db["quote"].find({"client_id": client_id}).sort("created_at", -1)
-    return [serialize(q) for q in qs]
+async def list_quotes(client_id: str, after_id: Optional[str] = None, limit: int = Query(50, ge=1, le=500)):
+    return await newest_page("quote", {"client_id": client_id}, after_id, limit)
 
 
 @app.post("/quotes")
-def create_quote(payload: QuotePayload):
-    q = Quote(client_id=payload.client_id, work_request_id=payload.work_request_id, amount=payload.amount)
-    qid = create_document("quote", q)
+async def create_quote(payload: QuotePayload):
+    qid = await create_document("quote", {**payload.model_dump(), "status": "pending"})
     return {"id": qid}
 
 
 @app.post("/quotes/{quote_id}/authorize")
-def authorize_quote(quote_id: str, authorize: bool = True):
+async def authorize_quote(quote_id: str, authorize: bool = True):
     status = "authorized" if authorize else "rejected"
-    res = db["quote"].update_one({"_id": oid(quote_id)}, {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}})
+    res = await db["quote"].update_one({"_id": oid(quote_id)}, {"$set": {"status": status, "updated_at": datetime.now(timezone.utc)}})
     if res.matched_count == 0:
         raise HTTPException(status_code=404, detail="Quote not found")
     return {"status": status}
@@ -592,6 +807,8 @@ def authorize_quote(quote_id: str, authorize: bool = True):
 
 # ---------------------- Kanban Board ----------------------
 class KanbanCreatePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     client_id: str
     title: str
     description: Optional[str] = ""
@@ -600,6 +817,8 @@ class KanbanCreatePayload(BaseModel):
 
 
 class KanbanUpdatePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     title: Optional[str] = None
     description: Optional[str] = None
     status: Optional[Literal["todo", "in_progress", "under_review", "completed"]] = None
@@ -608,33 +827,40 @@ class KanbanUpdatePayload(BaseModel):
     position: Optional[float] = None
 
 
+async def next_position(client_id: str, status: str) -> float:
+    # Reads one entry off the top of the (client_id, status, position, ...) index
+    last = await db["kanbantask"].find_one(
+        {"client_id": client_id, "status": status}, {"position": 1}, sort=[("position", -1)]
+    )
+    return float(last.get("position", 0)) + 1.0 if last else 1.0
+
+
 @app.get("/kanban/tasks")
-def kanban_list(client_id: str, status: Optional[str] = None, search: Optional[str] = None, assignee: Optional[str] = None):
+async def kanban_list(
+    client_id: str,
+    status: Optional[str] = None,
+    search: Optional[str] = None,
+    assignee: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=2000),
+):
     q: Dict[str, Any] = {"client_id": client_id}
     if status:
         q["status"] = status
     if assignee:
         q["assignees"] = {"$in": [assignee]}
     if search:
-        q["$or"] = [
-            {"title": {"$regex": search, "$options": "i"}},
-            {"description": {"$regex": search, "$options": "i"}},
-        ]
-    tasks = db["kanbantask"].find(q).sort([("status", 1), ("position", 1), ("created_at", 1)])
-    return [serialize(t) for t in tasks]
+        # Served by the title/description text index instead of an unanchored regex COLLSCAN
+        q["$text"] = {"$search": search}
+    # The board renders whole columns, so this is a ceiling rather than a page size
+    tasks = db["kanbantask"].find(q).sort([("status", 1), ("position", 1), ("created_at", 1)]).limit(limit).batch_size(200)
+    return DocsResponse([serialize(t) async for t in tasks])
 
 
 @app.post("/kanban/tasks")
-def kanban_create(request: Request, payload: KanbanCreatePayload):
+async def kanban_create(request: Request, payload: KanbanCreatePayload):
     require_pm_or_admin(request)
-    # Compute next position in "todo" by default
-    column = "todo"
-    last = db["kanbantask"].find({"client_id": payload.client_id, "status": column}).sort("position", -1).limit(1)
-    next_pos = 1.0
-    if last:
-        last_list = list(last)
-        if last_list:
-            next_pos = float(last_list[0].get("position", 0)) + 1.0
+    # New tasks go to the end of "todo"
+    next_pos = await next_position(payload.client_id, "todo")
     task = Kanbantask(
         client_id=payload.client_id,
         title=payload.title,
@@ -644,71 +870,81 @@ def kanban_create(request: Request, payload: KanbanCreatePayload):
         assignees=payload.assignees or [],
         position=next_pos,
     )
-    tid = create_document("kanbantask", task)
+    tid = await create_document("kanbantask", task)
     # Notify
-    import asyncio
-    asyncio.create_task(manager.broadcast(payload.client_id, {"type": "kanban:create", "id": tid}))
+    manager.broadcast(payload.client_id, {"type": "kanban:create", "id": tid})
     return {"id": tid}
 
 
 @app.patch("/kanban/tasks/{task_id}")
-def kanban_update(request: Request, task_id: str, payload: KanbanUpdatePayload):
+async def kanban_update(request: Request, task_id: str, payload: KanbanUpdatePayload):
     require_pm_or_admin(request)
     update = {k: v for k, v in payload.model_dump().items() if v is not None}
     if not update:
-        t = db["kanbantask"].find_one({"_id": oid(task_id)})
+        t = await db["kanbantask"].find_one({"_id": oid(task_id)})
         if not t:
             raise HTTPException(status_code=404, detail="Task not found")
         return serialize(t)
     update["updated_at"] = datetime.now(timezone.utc)
-    res = db["kanbantask"].update_one({"_id": oid(task_id)}, {"$set": update})
-    if res.matched_count == 0:
+    t = await db["kanbantask"].find_one_and_update(
+        {"_id": oid(task_id)}, {"$set": update}, return_document=ReturnDocument.AFTER
+    )
+    if t is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    t = db["kanbantask"].find_one({"_id": oid(task_id)})
     # Notify
-    import asyncio
-    asyncio.create_task(manager.broadcast(t["client_id"], {"type": "kanban:update", "id": str(t["_id"]) }))
+    manager.broadcast(t["client_id"], {"type": "kanban:update", "id": str(t["_id"]) })
     return serialize(t)
 
 
 class KanbanMovePayload(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     to_status: Literal["todo", "in_progress", "under_review", "completed"]
     before_id: Optional[str] = None
     after_id: Optional[str] = None
 
 
 @app.post("/kanban/tasks/{task_id}/move")
-def kanban_move(request: Request, task_id: str, payload: KanbanMovePayload):
+async def kanban_move(request: Request, task_id: str, payload: KanbanMovePayload):
     require_pm_or_admin(request)
+    # Parse every id once up front; malformed ids fail with 400 before any DB work
+    tid = oid(task_id)
+    before_id = oid(payload.before_id) if payload.before_id else None
+    after_id = oid(payload.after_id) if payload.after_id else None
     # Determine new position based on neighbors
     to_col = payload.to_status
     pos: float
-    if payload.before_id and payload.after_id:
-        before = db["kanbantask"].find_one({"_id": oid(payload.before_id)})
-        after = db["kanbantask"].find_one({"_id": oid(payload.after_id)})
+    if before_id and after_id:
+        before = await db["kanbantask"].find_one({"_id": before_id}, {"position": 1})
+        after = await db["kanbantask"].find_one({"_id": after_id}, {"position": 1})
         if not (before and after):
             raise HTTPException(status_code=400, detail="Invalid neighbor ids")
         pos = (float(before.get("position", 0)) + float(after.get("position", 0))) / 2.0
-    elif payload.before_id:
-        before = db["kanbantask"].find_one({"_id": oid(payload.before_id)})
+    elif before_id:
+        before = await db["kanbantask"].find_one({"_id": before_id}, {"position": 1})
+        if not before:
+            raise HTTPException(status_code=400, detail="Invalid neighbor ids")
         pos = float(before.get("position", 0)) - 1.0
-    elif payload.after_id:
-        after = db["kanbantask"].find_one({"_id": oid(payload.after_id)})
+    elif after_id:
+        after = await db["kanbantask"].find_one({"_id": after_id}, {"position": 1})
+        if not after:
+            raise HTTPException(status_code=400, detail="Invalid neighbor ids")
         pos = float(after.get("position", 0)) + 1.0
     else:
-        # Append to end of column
-        last = db["kanbantask"].find({"status": to_col}).sort("position", -1).limit(1)
-        pos = 1.0
-        last_list = list(last)
-        if last_list:
-            pos = float(last_list[0].get("position", 0)) + 1.0
-    res = db["kanbantask"].update_one({"_id": oid(task_id)}, {"$set": {"status": to_col, "position": pos, "updated_at": datetime.now(timezone.utc)}})
-    if res.matched_count == 0:
+        # Append to end of the task's column on its own board
+        task = await db["kanbantask"].find_one({"_id": tid}, {"client_id": 1})
+        if not task:
+            raise HTTPException(status_code=404, detail="Task not found")
+        pos = await next_position(task["client_id"], to_col)
+    t = await db["kanbantask"].find_one_and_update(
+        {"_id": tid},
+        {"$set": {"status": to_col, "position": pos, "updated_at": datetime.now(timezone.utc)}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if t is None:
         raise HTTPException(status_code=404, detail="Task not found")
-    t = db["kanbantask"].find_one({"_id": oid(task_id)})
     # Notify
-    import asyncio
-    asyncio.create_task(manager.broadcast(t["client_id"], {"type": "kanban:move", "id": str(t["_id"]) }))
+    manager.broadcast(t["client_id"], {"type": "kanban:move", "id": str(t["_id"]) })
     return serialize(t)
 
 
@@ -724,6 +960,84 @@ async def ws_kanban(websocket: WebSocket, client_id: str):
         manager.disconnect(client_id, websocket)
 
 
+# ---------------------- Batch ----------------------
+class SubRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    method: Literal["GET", "POST", "PATCH"]
+    path: str
+    body: Optional[Any] = None
+
+
+BATCH_MAX_CALLS = 20
+# Forwarded to every sub-request so each one is authorized like a direct call
+BATCH_FORWARD_HEADERS = ("authorization", "x-user-role")
+# Set on every sub-request; /batch refuses requests carrying it, so batches cannot nest
+BATCH_SUBREQUEST_HEADER = "x-batch-subrequest"
+# "{0.id}" -> the "id" field of sub-request 0's JSON response
+_BATCH_REF = re.compile(r"\{(\d+)\.(\w+)\}")
+# Sub-requests go through the full app (routing, validation, middleware) in-process, without a socket.
+# An unhandled error in one becomes a 500 in its own slot instead of failing the whole batch.
+_batch_client = httpx.AsyncClient(
+    transport=httpx.ASGITransport(app=app, raise_app_exceptions=False), base_url="http://batch"
+)
+
+
+def _resolve_refs(value: Any, results: List[Dict[str, Any]]) -> Any:
+    if isinstance(value, str):
+        return _BATCH_REF.sub(lambda m: str(results[int(m.group(1))]["body"][m.group(2)]), value)
+    if isinstance(value, list):
+        return [_resolve_refs(v, results) for v in value]
+    if isinstance(value, dict):
+        return {k: _resolve_refs(v, results) for k, v in value.items()}
+    return value
+
+
+def _build_subrequest(method: str, path: str, body: Any, headers: Dict[str, str]) -> httpx.Request:
+    # Only paths on this API: no scheme or host (which would override base_url), no /batch after normalization
+    parts = urlsplit(path)
+    if not path.startswith("/") or parts.scheme or parts.netloc:
+        raise ValueError("Sub-request paths must be absolute paths on this API")
+    try:
+        req = _batch_client.build_request(method, path, json=body, headers=headers)
+    except httpx.InvalidURL:
+        raise ValueError("Invalid sub-request path")
+    if req.url.path.startswith("/batch"):
+        raise ValueError("Nested batch calls are not allowed")
+    return req
+
+
+@app.post("/batch")
+async def batch(request: Request, calls: List[SubRequest]):
+    if BATCH_SUBREQUEST_HEADER in request.headers:
+        raise HTTPException(status_code=400, detail="Nested batch calls are not allowed")
+    if len(calls) > BATCH_MAX_CALLS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_CALLS} calls per batch")
+    headers = {k: v for k, v in request.headers.items() if k in BATCH_FORWARD_HEADERS}
+    headers[BATCH_SUBREQUEST_HEADER] = "1"
+    results: List[Dict[str, Any]] = []
+    for call in calls:
+        try:
+            path = _resolve_refs(call.path, results)
+            body = _resolve_refs(call.body, results)
+        except (IndexError, KeyError, TypeError):
+            # Referenced call is later in the batch, failed, or has no such field
+            results.append({"status": 424, "body": {"detail": "Unresolved reference"}})
+            continue
+        try:
+            req = _build_subrequest(call.method, path, body, headers)
+        except ValueError as e:
+            results.append({"status": 400, "body": {"detail": str(e)}})
+            continue
+        res = await _batch_client.send(req)
+        try:
+            out = orjson.loads(res.content) if res.content else None
+        except orjson.JSONDecodeError:
+            out = None
+        results.append({"status": res.status_code, "body": out})
+    return results
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
@@ -11,7 +11,8 @@ Model name is converted to lowercase for the collection name:
 - BlogPost -> "blogs" collection
 """
 
-from pydantic import BaseModel, Field
+from bson import ObjectId
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, Literal, List
 from datetime import datetime
 
@@ -29,7 +30,9 @@ class User(BaseModel):
 
 
 class Clientprofile(BaseModel):
-    user_id: str = Field(..., description="Linked user id")
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    user_id: ObjectId = Field(..., description="Linked user _id (stored as ObjectId so joins match user._id)")
     display_name: str = Field(..., description="Client display name")
     theme_color: Optional[str] = Field("#4f46e5", description="Brand color hex")
     logo_url: Optional[str] = Field(None, description="URL to logo image")
@@ -80,7 +83,9 @@ class Quote(BaseModel):
 
 # Simple auth token storage
 class Token(BaseModel):
-    user_id: str
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    user_id: ObjectId
     token: str
     expires_at: Optional[datetime] = None
 
@@ -14,6 +14,25 @@ fi
 mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
+# Compiled helpers live in build/mypyc, never next to helpers.py: a .so in the repo root
+# would shadow the source for dev and test runs. Only the server puts it first on sys.path
+# (--app-dir); main itself is found through PYTHONPATH.
+# A reloaded worker would keep importing the stale compiled module after helpers.py edits,
+# so --reload is only used with the pure-Python helpers.
+rm -f helpers.*.so
+rm -rf build/mypyc
+RELOAD="--reload"
+if command -v mypyc >/dev/null 2>&1; then
+  echo "Compiling hot-path helpers with mypyc..."
+  mkdir -p build/mypyc && cp helpers.py build/mypyc/
+  if (cd build/mypyc && mypyc helpers.py); then
+    echo "Using compiled helpers; auto-reload disabled (rerun this script after editing helpers.py)"
+    RELOAD=""
+  else
+    echo "mypyc build failed, using pure-Python helpers"
+    rm -rf build/mypyc
+  fi
+fi
 echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
+PYTHONPATH=".${PYTHONPATH:+:$PYTHONPATH}" nohup uvicorn main:app --app-dir build/mypyc --host 0.0.0.0 --port 8000 --loop uvloop --http httptools $RELOAD > logs/server.log 2>&1 
 echo "Server started in background"
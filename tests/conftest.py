@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+
+import httpx
+import orjson
+import pytest
+from dotenv import load_dotenv
+from fastapi.testclient import TestClient
+from bson import ObjectId
+from pymongo import monitoring
+
+
+def _orjson_body(kwargs):
+    # json= bodies are encoded with orjson here instead of letting httpx run them through stdlib json
+    body = kwargs.pop("json", None)
+    if body is not None:
+        kwargs["content"] = orjson.dumps(body)
+        kwargs["headers"] = {**(kwargs.get("headers") or {}), "content-type": "application/json"}
+    return kwargs
+
+
+class _Client(TestClient):
+    def request(self, method, url, **kwargs):
+        return super().request(method, url, **_orjson_body(kwargs))
+
+
+class _AsyncClient(httpx.AsyncClient):
+    async def request(self, method, url, **kwargs):
+        return await super().request(method, url, **_orjson_body(kwargs))
+
+
+class _InsertedIds(monitoring.CommandListener):
+    """Records the _id of every document the app inserts or upserts, per collection."""
+
+    def __init__(self):
+        self.ids = defaultdict(set)
+        self._upserts = {}
+
+    def started(self, event):
+        if event.command_name == "insert":
+            coll = event.command["insert"]
+            self.ids[coll].update(d["_id"] for d in event.command.get("documents", ()))
+        elif event.command_name in ("update", "findAndModify"):
+            self._upserts[event.request_id] = event.command[event.command_name]
+
+    def succeeded(self, event):
+        coll = self._upserts.pop(event.request_id, None)
+        if coll is None:
+            return
+        reply = event.reply
+        self.ids[coll].update(u["_id"] for u in reply.get("upserted", ()))
+        upserted = reply.get("lastErrorObject", {}).get("upserted")
+        if upserted is not None:
+            self.ids[coll].add(upserted)
+
+    def failed(self, event):
+        self._upserts.pop(event.request_id, None)
+
+    def take(self):
+        ids, self.ids = self.ids, defaultdict(set)
+        return ids
+
+
+# All of this must be in place before main is imported: TESTING exposes app.state.last_otp,
+# database.py reads DATABASE_NAME at import, and the listener has to be registered before
+# main creates its Motor client
+os.environ.setdefault("TESTING", "1")
+load_dotenv()
+# Uploaded files (logos, documents) go to a throwaway dir instead of the repo's uploads/
+_upload_dir = os.environ["UPLOAD_DIR"] = tempfile.mkdtemp(prefix="uploads-")
+# Each xdist worker (pytest -n auto) gets its own database; plain runs use the gw0 one
+if os.getenv("DATABASE_NAME"):
+    os.environ["DATABASE_NAME"] = f"{os.environ['DATABASE_NAME']}_test_{os.getenv('PYTEST_XDIST_WORKER', 'gw0')}"
+_inserted = _InsertedIds()
+monitoring.register(_inserted)
+
+from database import insert_document  # noqa: E402
+from helpers import serialize  # noqa: E402
+from main import app, db, get_client_profile  # noqa: E402
+from schemas import Clientprofile  # noqa: E402
+from tests.support import make_email, ok  # noqa: E402
+
+
+def _purge(client, inserted):
+    # The app writes outside any test-owned session, so a transaction abort would not undo them
+    async def purge():
+        for coll, ids in inserted.items():
+            if ids:
+                await db[coll].delete_many({"_id": {"$in": list(ids)}})
+    client.portal.call(purge)
+
+
+@pytest.fixture(scope="session")
+def client():
+    # One app lifespan per session; Motor also binds to the first event loop it runs on
+    with _Client(app) as c:
+        yield c
+    shutil.rmtree(_upload_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _warmup(client):
+    # Pay first-request costs (route/validator setup, DB pool, model schemas) before any test is timed;
+    # app.openapi() builds and caches the JSON schema of every request/response model
+    client.get("/test")
+    app.openapi()
+
+
+@pytest.fixture(scope="session")
+def aclient(client):
+    # In-process async client for concurrent calls; it runs on the TestClient's portal loop,
+    # which is the loop Motor is bound to, so no pytest-asyncio loop is involved
+    ac = _AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver")
+    yield ac
+    client.portal.call(ac.aclose)
+
+
+@pytest.fixture(autouse=True)
+def _rollback(client):
+    # Everything a test inserts is deleted again in teardown
+    _inserted.take()
+    yield
+    _purge(client, _inserted.take())
+
+
+# Pre-encoded login body; make_email output is plain ASCII, so it can be spliced in without JSON escaping
+_LOGIN_TMPL = b'{"email":"%s","name":"Login User","role":"admin"}'
+JSON_HDR = {"content-type": "application/json"}
+
+
+@pytest.fixture(scope="session")
+def profile(client):
+    # Tests only need *a* valid client profile, so it is written straight to the collection
+    # instead of going through POST /clients; one per session, deleted at the end
+    doc = Clientprofile(user_id=ObjectId(), display_name="Test Client", theme_color="#22c55e")
+    prof = serialize(client.portal.call(insert_document, "clientprofile", doc))
+    yield prof
+    client.portal.call(db["clientprofile"].delete_one, {"_id": ObjectId(prof["id"])})
+
+
+@pytest.fixture
+def restore_branding(client, profile):
+    # For tests that change the shared profile. PATCH skips null fields (logo_url, notes start as None),
+    # so the snapshot is written back directly and the profile cache dropped.
+    yield
+    fields = {k: profile[k] for k in ("display_name", "theme_color", "logo_url", "notes")}
+    client.portal.call(db["clientprofile"].update_one, {"_id": ObjectId(profile["id"])}, {"$set": fields})
+    get_client_profile.cache_invalidate(profile["id"])
+
+
+@pytest.fixture(scope="session")
+def admin_token(client):
+    # Issued once per session; tests assert against it instead of logging in again
+    _inserted.take()
+    email = make_email("login")
+    token = ok(client.post("/auth/login", content=_LOGIN_TMPL % email.encode(), headers=JSON_HDR)).json()["token"]
+    created = _inserted.take()
+    yield token, email
+    _purge(client, created)
@@ -0,0 +1,27 @@
+"""Plain helpers shared by conftest.py and the test modules (importable as tests.support)."""
+
+import asyncio
+import itertools
+import os
+
+
+def gather(client, *aws):
+    # Await independent aclient calls concurrently and return their results in order
+    async def run():
+        return await asyncio.gather(*aws)
+    return client.portal.call(run)
+
+
+# Unique per process (xdist workers included) and per call, without building datetimes or uuids
+_email_ctr = itertools.count()
+_email_nonce = os.urandom(4).hex()
+
+
+def make_email(prefix: str = "user") -> str:
+    return f"{prefix}-{_email_nonce}-{next(_email_ctr)}@example.com"
+
+
+def ok(res, code=200):
+    # Status check that hands the response back for chaining: ok(client.get(...)).json()
+    assert res.status_code == code, res.text
+    return res
@@ -1,132 +1,198 @@
-import os
-import io
-import json
-from datetime import datetime, timedelta
+"""API tests. PYTEST_DONT_REWRITE: plain asserts here; status checks go through support.ok(), which reports the body."""
 
-from fastapi.testclient import TestClient
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException, Request
 
-# Import the running FastAPI app
-from main import app, db
+# The app and its TestClient come from the session fixtures in conftest.py
+import main
+from main import KanbanCreatePayload, app, kanban_create
+from tests.support import gather, make_email, ok
 
-client = TestClient(app)
 
+PM_HDR = {"X-User-Role": "project_manager"}
+ADMIN_HDR = {"X-User-Role": "admin"}
 
-def make_email(prefix: str = "user") -> str:
-    return f"{prefix}-{datetime.utcnow().timestamp()}@example.com"
+_FAKE_PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + b"\x00" * 16
 
 
-def create_client_profile():
-    # Create a client via API to ensure consistent data
-    email = make_email("client")
-    res = client.post("/clients", json={
-        "email": email,
-        "name": "Test Client",
-        "company": "Test Co",
-        "theme_color": "#22c55e",
-        "logo_url": None,
-    })
-    assert res.status_code == 200, res.text
-    ids = res.json()
-    # Fetch profile
-    prof = client.get(f"/clients/{ids['profile_id']}")
-    assert prof.status_code == 200
-    return prof.json()
-
-
-def test_health_and_db():
-    r = client.get("/test")
-    assert r.status_code == 200
-    data = r.json()
+def test_health_and_db(client):
+    data = ok(client.get("/test")).json()
     assert "backend" in data
 
 
-def test_otp_flow_creates_token():
+def test_otp_flow_creates_token(client):
     email = make_email("otp")
     # Request OTP
-    r = client.post("/auth/request-otp", json={"email": email, "name": "OTP User", "role": "client"})
-    assert r.status_code == 200
-    # Retrieve code from DB directly (demo env)
-    rec = db["otp"].find_one({"email": email})
-    assert rec and rec.get("code")
-    code = rec["code"]
+    ok(client.post("/auth/request-otp", json={"email": email, "name": "OTP User", "role": "client"}))
+    # Read the issued code from the app's test hook instead of the otp collection
+    code = app.state.last_otp[email]
     # Verify OTP
-    v = client.post("/auth/verify-otp", json={"email": email, "code": code})
-    assert v.status_code == 200, v.text
-    payload = v.json()
+    payload = ok(client.post("/auth/verify-otp", json={"email": email, "code": code})).json()
     assert "token" in payload and payload["token"]
     assert "user" in payload and payload["user"]
 
 
-def test_basic_login_and_me():
-    email = make_email("login")
-    r = client.post("/auth/login", json={"email": email, "name": "Login User", "role": "admin"})
-    assert r.status_code == 200
-    tok = r.json()["token"]
-    me = client.get(f"/auth/me?token={tok}")
-    assert me.status_code == 200
-    user = me.json()
+def test_basic_login_and_me(client, admin_token):
+    tok, email = admin_token
+    user = ok(client.get(f"/auth/me?token={tok}")).json()
     assert user["email"] == email
 
 
-def test_kanban_create_and_move():
-    prof = create_client_profile()
-    headers = {"X-User-Role": "project_manager"}
-    # Create task
-    r = client.post("/kanban/tasks", headers=headers, json={
-        "client_id": prof["id"],
-        "title": "Install scaffolding",
-        "description": "North wall",
-        "assignees": [],
-        "due_date": None
-    })
-    assert r.status_code == 200, r.text
-    task_id = r.json()["id"]
-
-    # Move task to in_progress (append)
-    m = client.post(f"/kanban/tasks/{task_id}/move", headers=headers, json={
-        "to_status": "in_progress",
-        "before_id": None,
-        "after_id": None
-    })
-    assert m.status_code == 200, m.text
-    moved = m.json()
-    assert moved["status"] == "in_progress"
-
-
-def test_logo_upload_and_patch_branding():
-    prof = create_client_profile()
-    headers = {"X-User-Role": "admin"}
-
-    # Upload a tiny PNG header
-    fake_png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + os.urandom(16)
-    files = {"file": ("logo.png", io.BytesIO(fake_png), "image/png")}
-    up = client.post(f"/clients/{prof['id']}/logo", headers=headers, files=files)
-    assert up.status_code == 200, up.text
-    url = up.json()["url"]
+def test_logout_evicts_cached_token(client):
+    tok = ok(client.post("/auth/login", json={"email": make_email("logout"), "role": "admin"})).json()["token"]
+    ok(client.get(f"/auth/me?token={tok}"))  # now served from the token cache
+    ok(client.post(f"/auth/logout?token={tok}"))
+    ok(client.get(f"/auth/me?token={tok}"), 401)
+
+
+def test_messages_keyset_pages(client):
+    client_id = str(ObjectId())
+    for i in range(3):
+        ok(client.post("/messages", json={"client_id": client_id, "sender_id": "u1", "sender_role": "client", "content": f"m{i}"}))
+    first = ok(client.get(f"/messages?client_id={client_id}&limit=2"))
+    cursor = first.headers["X-Next-Cursor"]
+    second = ok(client.get(f"/messages?client_id={client_id}&limit=2&after_id={cursor}"))
+    assert "X-Next-Cursor" not in second.headers
+    # The deprecated ?after= spelling reads the same cursor
+    assert ok(client.get(f"/messages?client_id={client_id}&limit=2&after={cursor}")).json() == second.json()
+    # Oldest first, no overlap between pages
+    assert [m["content"] for m in first.json() + second.json()] == ["m0", "m1", "m2"]
+    for limit in (0, 501):
+        ok(client.get(f"/messages?client_id={client_id}&limit={limit}"), 422)
+
+
+def test_notifications_keyset_pages(client):
+    user_id = str(ObjectId())
+    ids = [ok(client.post("/notifications", json={"user_id": user_id, "text": f"n{i}"})).json()["id"] for i in range(3)]
+    first = ok(client.get(f"/notifications?user_id={user_id}&limit=2"))
+    second = ok(client.get(f"/notifications?user_id={user_id}&limit=2&after_id={first.headers['X-Next-Cursor']}"))
+    assert "X-Next-Cursor" not in second.headers
+    # Newest first, no overlap between pages
+    assert [n["id"] for n in first.json() + second.json()] == ids[::-1]
+    for limit in (0, 501):
+        ok(client.get(f"/notifications?user_id={user_id}&limit={limit}"), 422)
+
+
+def test_create_client_then_list(client):
+    # The shared profile fixture skips POST /clients, so the create path and the user_obj join are checked here
+    email = make_email("client")
+    created = ok(client.post("/clients", json={"email": email, "name": "New Client"})).json()
+    listed = {p["id"]: p for p in ok(client.get("/clients")).json()}
+    prof = listed[created["profile_id"]]
+    assert prof["user_id"] == created["user_id"]
+    assert [(u["id"], u["email"]) for u in prof["user_obj"]] == [(created["user_id"], email)]
+    ok(client.post("/clients", json={"email": email, "name": "Again"}), 409)
+
+
+def test_kanban_create_and_move(client, profile):
+    # Create the task and move it to in_progress (append) in one batch; {0.id} is the created task
+    created, moved = ok(client.post("/batch", headers=PM_HDR, json=[
+        {"method": "POST", "path": "/kanban/tasks", "body": {
+            "client_id": profile["id"],
+            "title": "Install scaffolding",
+            "description": "North wall",
+            "assignees": [],
+            "due_date": None
+        }},
+        {"method": "POST", "path": "/kanban/tasks/{0.id}/move", "body": {
+            "to_status": "in_progress",
+            "before_id": None,
+            "after_id": None
+        }},
+    ])).json()
+    assert created["status"] == 200, created
+    assert moved["status"] == 200, moved
+    assert moved["body"]["id"] == created["body"]["id"]
+    assert moved["body"]["status"] == "in_progress"
+
+
+@pytest.mark.parametrize("path", ["/batch", "batch", "http://evil/batch", "//evil/batch", "/%62atch"])
+def test_batch_rejects_nested_and_foreign_paths(client, path):
+    (res,) = ok(client.post("/batch", headers=PM_HDR, json=[{"method": "POST", "path": path, "body": []}])).json()
+    assert res["status"] == 400, res
+
+
+def test_batch_rejects_nested_batch_via_reference(client, profile):
+    # The move response echoes the task, so {1.title} resolves to "/batch"; the resolved path is what gets checked
+    task, moved, nested = ok(client.post("/batch", headers=PM_HDR, json=[
+        {"method": "POST", "path": "/kanban/tasks", "body": {"client_id": profile["id"], "title": "/batch"}},
+        {"method": "POST", "path": "/kanban/tasks/{0.id}/move", "body": {"to_status": "completed"}},
+        {"method": "POST", "path": "{1.title}", "body": []},
+    ])).json()
+    assert task["status"] == 200 and moved["status"] == 200, (task, moved)
+    assert nested["status"] == 400, nested
+    # Sub-requests are tagged, so /batch itself refuses them even if a path slipped through
+    ok(client.post("/batch", headers={**PM_HDR, "x-batch-subrequest": "1"}, json=[]), 400)
+
+
+def test_batch_call_cap_and_unresolved_reference(client):
+    ok(client.post("/batch", headers=PM_HDR, json=[{"method": "GET", "path": "/test"}] * 21), 400)
+    first, later, missing = ok(client.post("/batch", headers=PM_HDR, json=[
+        {"method": "GET", "path": "/test"},
+        {"method": "GET", "path": "/clients/{2.id}"},
+        {"method": "GET", "path": "/clients/{0.nope}"},
+    ])).json()
+    assert first["status"] == 200, first
+    assert later["status"] == 424 and missing["status"] == 424, (later, missing)
+
+
+def test_batch_keeps_earlier_results_when_a_call_crashes(client, profile, monkeypatch):
+    tid = ok(client.post("/kanban/tasks", headers=PM_HDR, json={"client_id": profile["id"], "title": "Crash"})).json()["id"]
+
+    async def boom(*args):
+        raise RuntimeError("boom")
+    # Moving a task without neighbours appends it through next_position; make that crash
+    monkeypatch.setattr(main, "next_position", boom)
+    msg, crashed = ok(client.post("/batch", headers=PM_HDR, json=[
+        {"method": "POST", "path": "/messages", "body": {
+            "client_id": profile["id"], "sender_id": "u1", "sender_role": "admin", "content": "before the crash"
+        }},
+        {"method": "POST", "path": f"/kanban/tasks/{tid}/move", "body": {"to_status": "todo"}},
+    ])).json()
+    assert msg["status"] == 200 and msg["body"]["id"], msg
+    assert crashed["status"] == 500, crashed
+
+
+def test_kanban_move_rejects_unknown_neighbor(client, profile):
+    tid = ok(client.post("/kanban/tasks", headers=PM_HDR, json={"client_id": profile["id"], "title": "Lonely"})).json()["id"]
+    for side in ("before_id", "after_id"):
+        body = {"to_status": "todo", side: str(ObjectId())}
+        ok(client.post(f"/kanban/tasks/{tid}/move", headers=PM_HDR, json=body), 400)
+
+
+def test_logo_upload_and_patch_branding(client, aclient, profile, restore_branding):
+    new_color = "#f59e0b"
+
+    # The logo upload (a tiny PNG header) and the branding patch touch different fields; send them concurrently
+    files = {"file": ("logo.png", _FAKE_PNG, "image/png")}
+    up, patch = gather(
+        client,
+        aclient.post(f"/clients/{profile['id']}/logo", headers=ADMIN_HDR, files=files),
+        aclient.patch(f"/clients/{profile['id']}", headers=ADMIN_HDR, json={
+            "display_name": "Branded Co",
+            "theme_color": new_color,
+            "notes": "Updated via tests"
+        }),
+    )
+    url = ok(up).json()["url"]
     assert url.startswith("/uploads/")
+    assert ok(patch).json()["theme_color"] == new_color
 
-    # Patch branding
-    new_color = "#f59e0b"
-    patch = client.patch(f"/clients/{prof['id']}", headers=headers, json={
-        "display_name": "Branded Co",
-        "theme_color": new_color,
-        "logo_url": url,
-        "notes": "Updated via tests"
-    })
-    assert patch.status_code == 200, patch.text
-    body = patch.json()
+    # Both writes are visible once they have landed
+    body = ok(client.get(f"/clients/{profile['id']}")).json()
     assert body["theme_color"] == new_color
     assert body["logo_url"] == url
 
 
-def test_role_enforcement_for_kanban():
-    prof = create_client_profile()
-    # Attempt to create task as read-only viewer should fail
-    r = client.post("/kanban/tasks", headers={"X-User-Role": "viewer"}, json={
-        "client_id": prof["id"],
-        "title": "Unauthorized",
-        "description": "",
-        "assignees": [],
-        "due_date": None
-    })
-    assert r.status_code == 403
+@pytest.mark.parametrize("role,code", [("project_manager", 200), ("admin", 200), ("viewer", 403), ("client", 403)])
+def test_role_enforcement_for_kanban(client, profile, role, code):
+    # Pure role check: call the handler directly, no ASGI round trip
+    request = Request({"type": "http", "headers": [(b"x-user-role", role.encode())]})
+    payload = KanbanCreatePayload(client_id=profile["id"], title=f"Role {role}", description="", assignees=[], due_date=None)
+    try:
+        client.portal.call(kanban_create, request, payload)
+        status = 200
+    except HTTPException as exc:
+        status = exc.status_code
+    assert status == code, (role, status)